@@ -1,8 +1,8 @@
 from datetime import date, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 import numpy as np
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, and_, select
 
 from app.database import SleepRecord, ActivityRecord, VitalsRecord, DerivedMetric
 
@@ -10,78 +10,78 @@ from app.database import SleepRecord, ActivityRecord, VitalsRecord, DerivedMetri
 class HealthAnalytics:
     """Compute derived metrics and analyze health data trends"""
     
-    def __init__(self, db: Session):
+    def __init__(self, db: AsyncSession):
         self.db = db
+        # Summaries memoized for the lifetime of this instance (one request)
+        self._cache: Dict[Tuple[str, int, date], Optional[Dict]] = {}
     
-    def compute_derived_metrics(self, target_date: date) -> Optional[Dict]:
-        """Compute derived metrics for a specific date"""
-        sleep_record = self.db.query(SleepRecord).filter(
-            SleepRecord.date == target_date
-        ).first()
-        
-        if not sleep_record:
-            return None
-        
-        metrics = {}
-        
-        # Sleep fragmentation index (awake time / time in bed)
-        if sleep_record.time_in_bed_minutes and sleep_record.time_in_bed_minutes > 0:
-            metrics['sleep_fragmentation_index'] = (
-                sleep_record.awake_minutes / sleep_record.time_in_bed_minutes
-            ) * 100
-        else:
-            metrics['sleep_fragmentation_index'] = 0
-        
-        # REM percentage
-        if sleep_record.time_asleep_minutes and sleep_record.time_asleep_minutes > 0:
-            metrics['rem_percentage'] = (
-                sleep_record.rem_minutes / sleep_record.time_asleep_minutes
-            ) * 100
-        else:
-            metrics['rem_percentage'] = 0
-        
-        # Deep percentage
-        if sleep_record.time_asleep_minutes and sleep_record.time_asleep_minutes > 0:
-            metrics['deep_percentage'] = (
-                sleep_record.deep_minutes / sleep_record.time_asleep_minutes
-            ) * 100
-        else:
-            metrics['deep_percentage'] = 0
-        
-        # Sleep efficiency (time asleep / time in bed)
-        if sleep_record.time_in_bed_minutes and sleep_record.time_in_bed_minutes > 0:
-            metrics['sleep_efficiency'] = (
-                sleep_record.time_asleep_minutes / sleep_record.time_in_bed_minutes
-            ) * 100
-        else:
-            metrics['sleep_efficiency'] = 0
-        
-        # Sleep consistency score (based on bedtime variance)
-        metrics['sleep_consistency_score'] = self._calculate_consistency_score(target_date)
-        
-        return metrics
+    async def compute_derived_metrics_bulk(self, start_date: date, end_date: date, days: int = 7) -> Dict[date, Dict]:
+        """Compute derived metrics for every sleep record in a date range"""
+        # Include the consistency look-back window before start_date
+        rows = (await self.db.execute(
+            select(
+                SleepRecord.date,
+                SleepRecord.bedtime,
+                func.coalesce(SleepRecord.time_in_bed_minutes, 0),
+                func.coalesce(SleepRecord.time_asleep_minutes, 0),
+                func.coalesce(SleepRecord.awake_minutes, 0),
+                func.coalesce(SleepRecord.rem_minutes, 0),
+                func.coalesce(SleepRecord.deep_minutes, 0)
+            ).where(
+                SleepRecord.date >= start_date - timedelta(days=days),
+                SleepRecord.date <= end_date
+            ).order_by(SleepRecord.date)
+        )).all()
+        
+        if not rows:
+            return {}
+        
+        count = len(rows)
+        dates = [r[0] for r in rows]
+        ordinals = np.fromiter((d.toordinal() for d in dates), dtype=np.int64, count=count)
+        values = np.fromiter((r[2:] for r in rows), dtype=(np.float64, 5), count=count)
+        time_in_bed, time_asleep, awake, rem, deep = values.T
+        bedtime_hours = self._bedtime_hours([r[1] for r in rows])
+        
+        in_bed = time_in_bed > 0
+        asleep = time_asleep > 0
+        fragmentation = np.divide(awake, time_in_bed, out=np.zeros_like(awake), where=in_bed) * 100
+        rem_pct = np.divide(rem, time_asleep, out=np.zeros_like(rem), where=asleep) * 100
+        deep_pct = np.divide(deep, time_asleep, out=np.zeros_like(deep), where=asleep) * 100
+        efficiency = np.divide(time_asleep, time_in_bed, out=np.zeros_like(time_asleep), where=in_bed) * 100
+        
+        results = {}
+        first = int(np.searchsorted(ordinals, start_date.toordinal()))
+        
+        for i in range(first, len(dates)):
+            window_start = int(np.searchsorted(ordinals, ordinals[i] - days))
+            window = bedtime_hours[window_start:i + 1]
+            
+            results[dates[i]] = {
+                'sleep_fragmentation_index': float(fragmentation[i]),
+                'rem_percentage': float(rem_pct[i]),
+                'deep_percentage': float(deep_pct[i]),
+                'sleep_efficiency': float(efficiency[i]),
+                'sleep_consistency_score': self._score_bedtime_variance(window[~np.isnan(window)])
+            }
+        
+        return results
     
-    def _calculate_consistency_score(self, target_date: date, days: int = 7) -> float:
-        """Calculate sleep consistency based on bedtime variance"""
-        start_date = target_date - timedelta(days=days)
-        
-        records = self.db.query(SleepRecord).filter(
-            and_(
-                SleepRecord.date >= start_date,
-                SleepRecord.date <= target_date,
-                SleepRecord.bedtime.isnot(None)
-            )
-        ).all()
-        
-        if len(records) < 2:
+    @staticmethod
+    def _bedtime_hours(bedtimes) -> np.ndarray:
+        """Convert bedtimes to hour + minute as decimal hours (NaN where missing)"""
+        minutes = np.array(bedtimes, dtype='datetime64[m]').ravel()
+        missing = np.isnat(minutes)
+        hours = (minutes.astype(np.int64) % 1440) / 60
+        hours[missing] = np.nan
+        return hours
+    
+    @staticmethod
+    def _score_bedtime_variance(bedtimes) -> float:
+        """Convert a set of bedtimes (decimal hours) into a consistency score"""
+        if len(bedtimes) < 2:
             return 100.0
         
-        # Extract hour + minute as decimal hours
-        bedtimes = []
-        for record in records:
-            hour = record.bedtime.hour + record.bedtime.minute / 60
-            bedtimes.append(hour)
-        
         # Calculate standard deviation
         std_dev = np.std(bedtimes)
         
@@ -91,34 +91,55 @@ class HealthAnalytics:
         
         return round(consistency, 2)
     
-    def get_sleep_summary(self, days: int = 7) -> Optional[Dict]:
+    async def get_sleep_summary(self, days: int = 7) -> Optional[Dict]:
         """Get sleep summary for the last N days"""
         end_date = date.today()
-        start_date = end_date - timedelta(days=days)
+        cache_key = ('sleep', days, end_date)
+        if cache_key in self._cache:
+            return self._cache[cache_key]
         
-        records = self.db.query(SleepRecord).filter(
-            and_(
-                SleepRecord.date >= start_date,
-                SleepRecord.date <= end_date
-            )
-        ).order_by(SleepRecord.date.desc()).all()
+        summary = await self._compute_sleep_summary(days, end_date)
+        self._cache[cache_key] = summary
+        return summary
+    
+    async def _compute_sleep_summary(self, days: int, end_date: date) -> Optional[Dict]:
+        start_date = end_date - timedelta(days=days)
         
-        if not records:
+        date_range = and_(
+            SleepRecord.date >= start_date,
+            SleepRecord.date <= end_date
+        )
+        
+        # Aggregate in the database; NULLIF keeps zero values out of the averages
+        record_count, avg_time_asleep, avg_rem, avg_deep, avg_awake = (await self.db.execute(
+            select(
+                func.count(SleepRecord.id),
+                func.avg(func.nullif(SleepRecord.time_asleep_minutes, 0)),
+                func.avg(func.nullif(SleepRecord.rem_minutes, 0)),
+                func.avg(func.nullif(SleepRecord.deep_minutes, 0)),
+                func.avg(func.nullif(SleepRecord.awake_minutes, 0))
+            ).where(date_range)
+        )).one()
+        
+        if not record_count:
             return None
         
-        last_night = records[0] if records else None
-        
-        # Calculate averages
-        avg_time_asleep = np.mean([r.time_asleep_minutes for r in records if r.time_asleep_minutes])
-        avg_rem = np.mean([r.rem_minutes for r in records if r.rem_minutes])
-        avg_deep = np.mean([r.deep_minutes for r in records if r.deep_minutes])
-        avg_awake = np.mean([r.awake_minutes for r in records if r.awake_minutes])
-        
-        total_asleep = sum([r.time_asleep_minutes for r in records if r.time_asleep_minutes])
+        last_night = (await self.db.execute(
+            select(
+                SleepRecord.date,
+                SleepRecord.time_asleep_minutes,
+                SleepRecord.rem_minutes,
+                SleepRecord.deep_minutes,
+                SleepRecord.core_minutes,
+                SleepRecord.awake_minutes,
+                SleepRecord.bedtime,
+                SleepRecord.wake_time
+            ).where(date_range).order_by(SleepRecord.date.desc()).limit(1)
+        )).first()
         
         return {
             'last_night': {
-                'date': str(last_night.date) if last_night else None,
+                'date': last_night.date if last_night else None,
                 'time_asleep_hours': round(last_night.time_asleep_minutes / 60, 1) if last_night and last_night.time_asleep_minutes else 0,
                 'rem_minutes': round(last_night.rem_minutes, 1) if last_night and last_night.rem_minutes else 0,
                 'deep_minutes': round(last_night.deep_minutes, 1) if last_night and last_night.deep_minutes else 0,
@@ -137,90 +158,95 @@ class HealthAnalytics:
                 'rem_percentage': round((avg_rem / avg_time_asleep * 100), 1) if avg_time_asleep and avg_rem else 0,
                 'deep_percentage': round((avg_deep / avg_time_asleep * 100), 1) if avg_time_asleep and avg_deep else 0,
             },
-            'total_records': len(records)
+            'total_records': record_count
         }
     
-    def get_activity_summary(self, days: int = 7) -> Optional[Dict]:
+    async def get_activity_summary(self, days: int = 7) -> Optional[Dict]:
         """Get activity summary for the last N days"""
         end_date = date.today()
-        start_date = end_date - timedelta(days=days)
+        cache_key = ('activity', days, end_date)
+        if cache_key in self._cache:
+            return self._cache[cache_key]
         
-        records = self.db.query(ActivityRecord).filter(
-            and_(
-                ActivityRecord.date >= start_date,
-                ActivityRecord.date <= end_date
-            )
-        ).order_by(ActivityRecord.date.desc()).all()
+        summary = await self._compute_activity_summary(days, end_date)
+        self._cache[cache_key] = summary
+        return summary
+    
+    async def _compute_activity_summary(self, days: int, end_date: date) -> Optional[Dict]:
+        start_date = end_date - timedelta(days=days)
         
-        if not records:
+        date_range = and_(
+            ActivityRecord.date >= start_date,
+            ActivityRecord.date <= end_date
+        )
+        
+        record_count, avg_steps, avg_calories, avg_stand_hours = (await self.db.execute(
+            select(
+                func.count(ActivityRecord.id),
+                func.avg(func.nullif(ActivityRecord.steps, 0)),
+                func.avg(func.nullif(ActivityRecord.move_calories, 0)),
+                func.avg(func.nullif(ActivityRecord.stand_hours, 0))
+            ).where(date_range)
+        )).one()
+        
+        if not record_count:
             return None
         
-        yesterday = records[0] if records else None
-        
-        avg_steps = np.mean([r.steps for r in records if r.steps])
-        avg_calories = np.mean([r.move_calories for r in records if r.move_calories])
-        avg_stand_hours = np.mean([r.stand_hours for r in records if r.stand_hours])
+        yesterday = (await self.db.execute(
+            select(
+                ActivityRecord.date,
+                ActivityRecord.steps,
+                ActivityRecord.move_calories,
+                ActivityRecord.stand_hours
+            ).where(date_range).order_by(ActivityRecord.date.desc()).limit(1)
+        )).first()
         
         return {
             'yesterday': {
-                'date': str(yesterday.date) if yesterday else None,
+                'date': yesterday.date if yesterday else None,
                 'steps': yesterday.steps if yesterday else 0,
                 'move_calories': round(yesterday.move_calories, 1) if yesterday and yesterday.move_calories else 0,
                 'stand_hours': yesterday.stand_hours if yesterday else 0
             },
             f'{days}_day_average': {
-                'steps': int(avg_steps) if not np.isnan(avg_steps) else 0,
-                'move_calories': round(avg_calories, 1) if not np.isnan(avg_calories) else 0,
-                'stand_hours': int(avg_stand_hours) if not np.isnan(avg_stand_hours) else 0
+                'steps': int(avg_steps) if avg_steps is not None else 0,
+                'move_calories': round(avg_calories, 1) if avg_calories is not None else 0,
+                'stand_hours': int(avg_stand_hours) if avg_stand_hours is not None else 0
             },
-            'total_records': len(records)
+            'total_records': record_count
         }
     
-    def get_notable_patterns(self, days: int = 7) -> List[str]:
+    async def get_notable_patterns(self, days: int = 7) -> List[str]:
         """Identify notable patterns in recent data"""
         patterns = []
         
-        sleep_summary = self.get_sleep_summary(days)
-        activity_summary = self.get_activity_summary(days)
+        sleep_summary = await self.get_sleep_summary(days)
+        activity_summary = await self.get_activity_summary(days)
         
         if not sleep_summary or not activity_summary:
             return patterns
         
-        # Sleep duration comparison
-        last_night_hours = sleep_summary['last_night']['time_asleep_hours']
-        avg_hours = sleep_summary[f'{days}_day_average']['time_asleep_hours']
-        
-        if last_night_hours and avg_hours:
-            diff = last_night_hours - avg_hours
-            if abs(diff) > 0.5:
-                direction = "increased" if diff > 0 else "decreased"
-                patterns.append(
-                    f"Sleep duration {direction} by {abs(diff * 60):.0f} minutes compared to {days}-day average"
-                )
-        
-        # REM percentage comparison
-        last_rem_pct = sleep_summary['last_night']['rem_percentage']
-        avg_rem_pct = sleep_summary[f'{days}_day_average']['rem_percentage']
+        last_night = sleep_summary['last_night']
+        sleep_average = sleep_summary[f'{days}_day_average']
         
-        if last_rem_pct and avg_rem_pct:
-            diff = last_rem_pct - avg_rem_pct
-            if abs(diff) > 2:
-                direction = "increased" if diff > 0 else "decreased"
-                patterns.append(
-                    f"REM percentage {direction} by {abs(diff):.1f}% compared to {days}-day average"
-                )
+        # (label, summary key, threshold, difference formatter)
+        sleep_checks = (
+            ("Sleep duration", 'time_asleep_hours', 0.5, lambda diff: f"{abs(diff * 60):.0f} minutes"),
+            ("REM percentage", 'rem_percentage', 2, lambda diff: f"{abs(diff):.1f}%"),
+            ("Deep sleep percentage", 'deep_percentage', 2, lambda diff: f"{abs(diff):.1f}%"),
+        )
         
-        # Deep sleep comparison
-        last_deep_pct = sleep_summary['last_night']['deep_percentage']
-        avg_deep_pct = sleep_summary[f'{days}_day_average']['deep_percentage']
-        
-        if last_deep_pct and avg_deep_pct:
-            diff = last_deep_pct - avg_deep_pct
-            if abs(diff) > 2:
-                direction = "increased" if diff > 0 else "decreased"
-                patterns.append(
-                    f"Deep sleep percentage {direction} by {abs(diff):.1f}% compared to {days}-day average"
-                )
+        for label, key, threshold, format_diff in sleep_checks:
+            last_value = last_night[key]
+            avg_value = sleep_average[key]
+            
+            if last_value and avg_value:
+                diff = last_value - avg_value
+                if abs(diff) > threshold:
+                    direction = "increased" if diff > 0 else "decreased"
+                    patterns.append(
+                        f"{label} {direction} by {format_diff(diff)} compared to {days}-day average"
+                    )
         
         # Activity level comparison
         yesterday_steps = activity_summary['yesterday']['steps']
@@ -236,57 +262,53 @@ class HealthAnalytics:
         
         return patterns
     
-    def get_correlations(self) -> Dict:
+    async def get_correlations(self) -> Dict:
         """Calculate correlations between activity and sleep"""
         # Get last 30 days of data
         end_date = date.today()
         start_date = end_date - timedelta(days=30)
         
-        sleep_records = self.db.query(SleepRecord).filter(
-            and_(
-                SleepRecord.date >= start_date,
-                SleepRecord.date <= end_date
-            )
-        ).all()
-        
-        activity_records = self.db.query(ActivityRecord).filter(
-            and_(
+        # Date-aligned rows straight from the database
+        rows = (await self.db.execute(
+            select(
+                ActivityRecord.steps,
+                SleepRecord.time_asleep_minutes,
+                func.coalesce(SleepRecord.deep_minutes, 0),
+                func.coalesce(SleepRecord.rem_minutes, 0)
+            ).join(
+                SleepRecord, SleepRecord.date == ActivityRecord.date
+            ).where(
                 ActivityRecord.date >= start_date,
-                ActivityRecord.date <= end_date
+                ActivityRecord.date <= end_date,
+                ActivityRecord.steps > 0,
+                SleepRecord.time_asleep_minutes > 0
             )
-        ).all()
-        
-        # Build date-aligned data
-        sleep_dict = {r.date: r for r in sleep_records}
-        activity_dict = {r.date: r for r in activity_records}
-        
-        steps_list = []
-        sleep_duration_list = []
-        sleep_quality_list = []
-        
-        for d in [start_date + timedelta(days=x) for x in range((end_date - start_date).days + 1)]:
-            if d in sleep_dict and d in activity_dict:
-                if sleep_dict[d].time_asleep_minutes and activity_dict[d].steps:
-                    steps_list.append(activity_dict[d].steps)
-                    sleep_duration_list.append(sleep_dict[d].time_asleep_minutes / 60)
-                    
-                    # Sleep quality proxy: deep + REM percentage
-                    total_sleep = sleep_dict[d].time_asleep_minutes
-                    quality = 0
-                    if total_sleep > 0:
-                        quality = ((sleep_dict[d].deep_minutes or 0) + (sleep_dict[d].rem_minutes or 0)) / total_sleep * 100
-                    sleep_quality_list.append(quality)
+        )).all()
         
         correlations = {}
         
-        if len(steps_list) > 5:
-            # Correlation between steps and sleep duration
-            corr_duration = np.corrcoef(steps_list, sleep_duration_list)[0, 1]
-            correlations['steps_sleep_duration'] = round(float(corr_duration), 3)
+        if len(rows) > 5:
+            data = np.fromiter(rows, dtype=(np.float64, 4), count=len(rows))
+            steps = data[:, 0]
+            sleep_duration = data[:, 1] / 60
+            
+            # Sleep quality proxy: deep + REM percentage
+            sleep_quality = (data[:, 2] + data[:, 3]) / data[:, 1] * 100
             
-            # Correlation between steps and sleep quality
-            if sleep_quality_list:
-                corr_quality = np.corrcoef(steps_list, sleep_quality_list)[0, 1]
-                correlations['steps_sleep_quality'] = round(float(corr_quality), 3)
+            # Correlation between steps and sleep duration / sleep quality
+            corr_duration, corr_quality = self._correlate_with_steps(
+                steps, np.stack((sleep_duration, sleep_quality))
+            )
+            correlations['steps_sleep_duration'] = round(float(corr_duration), 3)
+            correlations['steps_sleep_quality'] = round(float(corr_quality), 3)
         
         return correlations
+    
+    @staticmethod
+    def _correlate_with_steps(steps: np.ndarray, series: np.ndarray) -> np.ndarray:
+        """Pearson r of steps against each row of series, sharing the steps moments"""
+        x = steps - steps.mean()
+        ys = series - series.mean(axis=1, keepdims=True)
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (ys @ x) / np.sqrt((x @ x) * np.einsum('ij,ij->i', ys, ys))
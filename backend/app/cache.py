@@ -0,0 +1,96 @@
+from datetime import date
+from functools import wraps
+from typing import Dict, Optional, Tuple
+import os
+import time
+
+import orjson
+from redis import asyncio as aioredis
+
+
+class ResponseCache:
+    """Cache JSON endpoint results in Redis, or in-process when no Redis URL is set"""
+
+    def __init__(self, redis_url: Optional[str] = None, prefix: str = "hs"):
+        self.prefix = prefix
+        self._redis = aioredis.from_url(redis_url) if redis_url else None
+        self._memory: Dict[str, Tuple[float, bytes]] = {}
+
+    def make_key(self, namespace: str, *parts) -> str:
+        """Build a cache key inside a namespace"""
+        return ":".join([self.prefix, namespace, *map(str, parts)])
+    
+    async def get(self, key: str) -> Optional[bytes]:
+        """Get a cached value, or None on a miss"""
+        if self._redis is not None:
+            try:
+                return await self._redis.get(key)
+            except aioredis.RedisError:
+                return None
+        
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._memory[key]
+            return None
+        return entry[1]
+
+    async def set(self, key: str, value: bytes, expire: int):
+        """Store a value for `expire` seconds"""
+        if self._redis is not None:
+            try:
+                await self._redis.set(key, value, ex=expire)
+            except aioredis.RedisError:
+                pass
+            return
+        
+        # Keys embed today's date, so drop expired entries rather than let them pile up
+        now = time.monotonic()
+        for stale_key in [k for k, (expires_at, _) in self._memory.items() if expires_at < now]:
+            del self._memory[stale_key]
+        
+        self._memory[key] = (now + expire, value)
+
+    async def clear(self, namespace: str):
+        """Drop every cached value in a namespace"""
+        pattern = f"{self.prefix}:{namespace}:"
+        
+        if self._redis is not None:
+            try:
+                async for key in self._redis.scan_iter(match=f"{pattern}*"):
+                    await self._redis.delete(key)
+            except aioredis.RedisError:
+                pass
+            return
+        
+        for key in [k for k in self._memory if k.startswith(pattern)]:
+            del self._memory[key]
+
+    async def close(self):
+        """Close the Redis connection pool"""
+        if self._redis is not None:
+            await self._redis.aclose()
+
+    def cached(self, namespace: str, expire: int = 120):
+        """Cache an async endpoint's result keyed by its query parameters (excluding `db`) and today's date"""
+        def decorator(func):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                params = ":".join(f"{k}={v}" for k, v in sorted(kwargs.items()) if k != "db")
+                key = self.make_key(namespace, func.__name__, date.today(), params)
+                
+                cached_value = await self.get(key)
+                if cached_value is not None:
+                    return orjson.loads(cached_value)
+                
+                result = await func(*args, **kwargs)
+                await self.set(key, orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY), expire)
+                return result
+            
+            return wrapper
+        
+        return decorator
+
+
+response_cache = ResponseCache(os.getenv("REDIS_URL"))
@@ -1,6 +1,6 @@
-from sqlalchemy import Column, Integer, Float, String, Date, DateTime, create_engine
+from sqlalchemy import Column, Integer, Float, String, Date, DateTime, Index, event, make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from datetime import datetime
 import os
 
@@ -9,6 +9,14 @@ Base = declarative_base()
 
 class SleepRecord(Base):
     __tablename__ = "sleep_records"
+    __table_args__ = (
+        # Covering index for the date-range aggregates in analytics
+        Index(
+            "ix_sleep_date_metrics",
+            "date", "time_asleep_minutes", "rem_minutes", "deep_minutes",
+            "awake_minutes", "time_in_bed_minutes"
+        ),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     date = Column(Date, unique=True, nullable=False, index=True)
@@ -25,6 +33,9 @@ class SleepRecord(Base):
 
 class ActivityRecord(Base):
     __tablename__ = "activity_records"
+    __table_args__ = (
+        Index("ix_activity_date_metrics", "date", "steps", "move_calories", "stand_hours"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     date = Column(Date, unique=True, nullable=False, index=True)
@@ -36,6 +47,13 @@ class ActivityRecord(Base):
 
 class VitalsRecord(Base):
     __tablename__ = "vitals_records"
+    __table_args__ = (
+        # Covering index for the date-window read endpoint
+        Index(
+            "ix_vitals_date_metrics",
+            "date", "resting_heart_rate", "sleeping_heart_rate", "respiratory_rate"
+        ),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     date = Column(Date, unique=True, nullable=False, index=True)
@@ -47,6 +65,14 @@ class VitalsRecord(Base):
 
 class DerivedMetric(Base):
     __tablename__ = "derived_metrics"
+    __table_args__ = (
+        # Covering index for the date-window read endpoint
+        Index(
+            "ix_derived_date_metrics",
+            "date", "sleep_consistency_score", "sleep_fragmentation_index",
+            "rem_percentage", "deep_percentage", "sleep_efficiency"
+        ),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     date = Column(Date, unique=True, nullable=False, index=True)
@@ -61,25 +87,48 @@ class DerivedMetric(Base):
 # Database setup
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./healthstats.db")
 
+# Use the async drivers for the configured database
+database_url = make_url(DATABASE_URL)
+if database_url.drivername == "sqlite":
+    database_url = database_url.set(drivername="sqlite+aiosqlite")
+elif database_url.drivername in ("postgresql", "postgresql+psycopg2"):
+    database_url = database_url.set(drivername="postgresql+asyncpg")
+
 # Handle SQLite vs PostgreSQL connection arguments
-if DATABASE_URL.startswith("sqlite"):
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+if database_url.get_backend_name() == "sqlite":
+    engine = create_async_engine(database_url)
+    
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        """Use WAL so readers are not blocked by the upload writer"""
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
 else:
-    # PostgreSQL or other databases don't need check_same_thread
-    engine = create_engine(DATABASE_URL)
+    # Sized so concurrent requests queue for a connection instead of exhausting the pool
+    engine = create_async_engine(database_url, pool_size=20, max_overflow=40, pool_pre_ping=True)
+
+AsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def _create_missing_indexes(connection):
+    # create_all skips indexes on tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=connection, checkfirst=True)
 
 
-def init_db():
+async def init_db():
     """Initialize database tables"""
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.create_all)
+        await connection.run_sync(_create_missing_indexes)
 
 
-def get_db():
+async def get_db():
     """Get database session"""
-    db = SessionLocal()
-    try:
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
@@ -1,14 +1,54 @@
 import httpx
-import json
-from typing import Dict, List
+import orjson
+from itertools import islice
+from typing import Dict, List, Optional
 
 
 class OllamaClient:
     """Client for interacting with local Ollama LLM"""
     
+    # Number of paragraphs kept from the LLM response
+    MAX_INSIGHTS = 4
+    
+    # Static prompt text; keeping it byte-identical lets Ollama reuse the cached prefix
+    _PROMPT_HEADER = """You are a neutral data analyst. Explain patterns and trends in the following health metrics using factual, neutral language.
+
+RULES:
+- Do not provide medical advice or diagnosis
+- Do not use motivational or coaching language
+- Do not say "you should" or give recommendations
+- Use phrases like "data shows", "compared to baseline", "trend indicates"
+- Be factual and analytical
+
+DATA:
+"""
+    
+    _PROMPT_FOOTER = """\n
+Provide 3-4 brief observations about the data. Focus on:
+1. How recent data compares to averages
+2. Any notable deviations or patterns
+3. Potential relationships between activity and sleep (if correlation data is available)
+
+Format each observation as a single paragraph. Be concise and factual.
+"""
+    
     def __init__(self, base_url: str = "http://localhost:11434", model: str = "llama3"):
         self.base_url = base_url
         self.model = model
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    @property
+    def client(self) -> httpx.AsyncClient:
+        """Shared HTTP client so connections are kept alive between calls"""
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(base_url=self.base_url, timeout=60.0)
+        return self._client
+    
+    async def aclose(self):
+        """Close the shared HTTP client"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
     
     async def generate_insights(self, context: Dict) -> Dict:
         """Generate health insights from structured data"""
@@ -18,33 +58,55 @@ class OllamaClient:
         
         # Call Ollama API
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    f"{self.base_url}/api/generate",
-                    json={
-                        "model": self.model,
-                        "prompt": prompt,
-                        "stream": False,
-                        "options": {
-                            "temperature": 0.3,  # Lower temperature for more factual output
-                            "top_p": 0.9
-                        }
+            generated_text = ""
+            
+            # Stream tokens so generation can stop once enough paragraphs are complete
+            async with self.client.stream(
+                "POST",
+                "/api/generate",
+                json={
+                    "model": self.model,
+                    "prompt": prompt,
+                    "stream": True,
+                    "options": {
+                        "temperature": 0.3,  # Lower temperature for more factual output
+                        "top_p": 0.9
                     }
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    generated_text = result.get("response", "")
-                    
-                    # Parse the response into structured insights
-                    insights = self._parse_llm_response(generated_text, context)
-                    return insights
-                else:
+                }
+            ) as response:
+                if response.status_code != 200:
                     return {
                         "error": f"Ollama API error: {response.status_code}",
                         "insights": [],
                         "summary": "Unable to generate insights at this time."
                     }
+                
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    
+                    chunk = orjson.loads(line)
+                    
+                    # Failures after the stream starts arrive as an error frame on a 200 response
+                    if "error" in chunk:
+                        return {
+                            "error": f"Ollama API error: {chunk['error']}",
+                            "insights": [],
+                            "summary": "Unable to generate insights at this time."
+                        }
+                    
+                    token = chunk.get("response", "")
+                    generated_text += token
+                    
+                    if chunk.get("done"):
+                        break
+                    
+                    if "\n" in token and self._count_complete_paragraphs(generated_text) >= self.MAX_INSIGHTS:
+                        break
+            
+            # Parse the response into structured insights
+            insights = self._parse_llm_response(generated_text, context)
+            return insights
         
         except Exception as e:
             return {
@@ -61,17 +123,7 @@ class OllamaClient:
         notable_patterns = context.get("notable_patterns", [])
         correlations = context.get("correlations", {})
         
-        prompt = """You are a neutral data analyst. Explain patterns and trends in the following health metrics using factual, neutral language.
-
-RULES:
-- Do not provide medical advice or diagnosis
-- Do not use motivational or coaching language
-- Do not say "you should" or give recommendations
-- Use phrases like "data shows", "compared to baseline", "trend indicates"
-- Be factual and analytical
-
-DATA:
-"""
+        parts = [self._PROMPT_HEADER]
         
         # Add sleep data
         if sleep_summary:
@@ -79,75 +131,94 @@ DATA:
             avg_7day = sleep_summary.get("7_day_average", {})
             avg_30day = sleep_summary.get("30_day_average", {})
             
-            prompt += f"\nSLEEP DATA:\n"
-            prompt += f"Last night ({last_night.get('date', 'N/A')}):\n"
-            prompt += f"  - Sleep duration: {last_night.get('time_asleep_hours', 0)} hours\n"
-            prompt += f"  - REM sleep: {last_night.get('rem_percentage', 0)}%\n"
-            prompt += f"  - Deep sleep: {last_night.get('deep_percentage', 0)}%\n"
-            prompt += f"  - Time awake: {last_night.get('awake_minutes', 0)} minutes\n"
-            prompt += f"  - Bedtime: {last_night.get('bedtime', 'N/A')}\n"
-            prompt += f"  - Wake time: {last_night.get('wake_time', 'N/A')}\n"
+            parts.append(
+                f"\nSLEEP DATA:\n"
+                f"Last night ({last_night.get('date', 'N/A')}):\n"
+                f"  - Sleep duration: {last_night.get('time_asleep_hours', 0)} hours\n"
+                f"  - REM sleep: {last_night.get('rem_percentage', 0)}%\n"
+                f"  - Deep sleep: {last_night.get('deep_percentage', 0)}%\n"
+                f"  - Time awake: {last_night.get('awake_minutes', 0)} minutes\n"
+                f"  - Bedtime: {last_night.get('bedtime', 'N/A')}\n"
+                f"  - Wake time: {last_night.get('wake_time', 'N/A')}\n"
+            )
             
-            prompt += f"\n7-day average:\n"
-            prompt += f"  - Sleep duration: {avg_7day.get('time_asleep_hours', 0)} hours\n"
-            prompt += f"  - REM sleep: {avg_7day.get('rem_percentage', 0)}%\n"
-            prompt += f"  - Deep sleep: {avg_7day.get('deep_percentage', 0)}%\n"
+            parts.append(
+                f"\n7-day average:\n"
+                f"  - Sleep duration: {avg_7day.get('time_asleep_hours', 0)} hours\n"
+                f"  - REM sleep: {avg_7day.get('rem_percentage', 0)}%\n"
+                f"  - Deep sleep: {avg_7day.get('deep_percentage', 0)}%\n"
+            )
             
             if avg_30day:
-                prompt += f"\n30-day average:\n"
-                prompt += f"  - Sleep duration: {avg_30day.get('time_asleep_hours', 0)} hours\n"
-                prompt += f"  - REM sleep: {avg_30day.get('rem_percentage', 0)}%\n"
-                prompt += f"  - Deep sleep: {avg_30day.get('deep_percentage', 0)}%\n"
+                parts.append(
+                    f"\n30-day average:\n"
+                    f"  - Sleep duration: {avg_30day.get('time_asleep_hours', 0)} hours\n"
+                    f"  - REM sleep: {avg_30day.get('rem_percentage', 0)}%\n"
+                    f"  - Deep sleep: {avg_30day.get('deep_percentage', 0)}%\n"
+                )
         
         # Add activity data
         if activity_summary:
             yesterday = activity_summary.get("yesterday", {})
             avg_7day = activity_summary.get("7_day_average", {})
             
-            prompt += f"\nACTIVITY DATA:\n"
-            prompt += f"Yesterday ({yesterday.get('date', 'N/A')}):\n"
-            prompt += f"  - Steps: {yesterday.get('steps', 0):,}\n"
-            prompt += f"  - Active calories: {yesterday.get('move_calories', 0)}\n"
-            prompt += f"  - Stand hours: {yesterday.get('stand_hours', 0)}\n"
+            parts.append(
+                f"\nACTIVITY DATA:\n"
+                f"Yesterday ({yesterday.get('date', 'N/A')}):\n"
+                f"  - Steps: {yesterday.get('steps', 0):,}\n"
+                f"  - Active calories: {yesterday.get('move_calories', 0)}\n"
+                f"  - Stand hours: {yesterday.get('stand_hours', 0)}\n"
+            )
             
-            prompt += f"\n7-day average:\n"
-            prompt += f"  - Steps: {avg_7day.get('steps', 0):,}\n"
-            prompt += f"  - Active calories: {avg_7day.get('move_calories', 0)}\n"
-            prompt += f"  - Stand hours: {avg_7day.get('stand_hours', 0)}\n"
+            parts.append(
+                f"\n7-day average:\n"
+                f"  - Steps: {avg_7day.get('steps', 0):,}\n"
+                f"  - Active calories: {avg_7day.get('move_calories', 0)}\n"
+                f"  - Stand hours: {avg_7day.get('stand_hours', 0)}\n"
+            )
         
         # Add notable patterns
         if notable_patterns:
-            prompt += f"\nNOTABLE PATTERNS:\n"
-            for pattern in notable_patterns:
-                prompt += f"  - {pattern}\n"
+            parts.append("\nNOTABLE PATTERNS:\n")
+            parts.extend(f"  - {pattern}\n" for pattern in notable_patterns)
         
         # Add correlations
         if correlations:
-            prompt += f"\nCORRELATIONS:\n"
-            for key, value in correlations.items():
-                prompt += f"  - {key}: {value}\n"
+            parts.append("\nCORRELATIONS:\n")
+            parts.extend(f"  - {key}: {value}\n" for key, value in correlations.items())
         
-        prompt += """\n
-Provide 3-4 brief observations about the data. Focus on:
-1. How recent data compares to averages
-2. Any notable deviations or patterns
-3. Potential relationships between activity and sleep (if correlation data is available)
-
-Format each observation as a single paragraph. Be concise and factual.
-"""
+        parts.append(self._PROMPT_FOOTER)
         
-        return prompt
+        return "".join(parts)
+    
+    @staticmethod
+    def _count_complete_paragraphs(text: str) -> int:
+        """Count non-empty paragraphs that have been terminated by a blank line"""
+        return sum(1 for p in text.split('\n\n')[:-1] if p.strip())
+    
+    @staticmethod
+    def _iter_paragraphs(text: str):
+        """Lazily yield stripped, non-empty paragraphs separated by blank lines"""
+        start = 0
+        while start <= len(text):
+            end = text.find('\n\n', start)
+            if end == -1:
+                end = len(text)
+            paragraph = text[start:end].strip()
+            if paragraph:
+                yield paragraph
+            start = end + 2
     
     def _parse_llm_response(self, response_text: str, context: Dict) -> Dict:
         """Parse LLM response into structured format"""
         
-        # Split response into paragraphs
-        paragraphs = [p.strip() for p in response_text.split('\n\n') if p.strip()]
+        # Split response into paragraphs, stopping once 4 have been found
+        paragraphs = list(islice(self._iter_paragraphs(response_text), self.MAX_INSIGHTS))
         
         insights = []
         categories = ['sleep_duration', 'sleep_stages', 'activity_correlation', 'general_pattern']
         
-        for i, paragraph in enumerate(paragraphs[:4]):  # Take up to 4 paragraphs
+        for i, paragraph in enumerate(paragraphs):
             if len(paragraph) > 20:  # Filter out very short lines
                 insights.append({
                     'category': categories[i] if i < len(categories) else 'general_pattern',
@@ -166,8 +237,7 @@ Format each observation as a single paragraph. Be concise and factual.
     async def check_connection(self) -> bool:
         """Check if Ollama is running and accessible"""
         try:
-            async with httpx.AsyncClient(timeout=5.0) as client:
-                response = await client.get(f"{self.base_url}/api/tags")
-                return response.status_code == 200
+            response = await self.client.get("/api/tags", timeout=5.0)
+            return response.status_code == 200
         except:
             return False
@@ -1,20 +1,47 @@
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Query
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, Query, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
-from sqlalchemy.orm import Session
+from fastapi.responses import ORJSONResponse
+from sqlalchemy import and_, func, select
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import date, timedelta, datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from logging.handlers import QueueHandler, QueueListener
+import asyncio
+import logging
+import multiprocessing
+import queue
 import shutil
-import os
+import tempfile
+import orjson
+from lxml import etree  # pyright: ignore[reportAttributeAccessIssue]
 
-from app.database import init_db, get_db, SleepRecord, ActivityRecord, VitalsRecord, DerivedMetric
+from app.database import init_db, get_db, engine, AsyncSessionLocal, SleepRecord, ActivityRecord, VitalsRecord, DerivedMetric
 from app.parser import AppleHealthParser
 from app.analytics import HealthAnalytics
 from app.llm import OllamaClient
+from app.cache import response_cache
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+# Records are formatted and enqueued by the caller; a listener thread does the stream I/O.
+# The handler is only attached to the root logger while the app (and listener) runs.
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_handler = QueueHandler(log_queue)
+log_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+log = logging.getLogger(__name__)
 
 app = FastAPI(
     title="HealthStats API",
     description="Apple Health data analytics with local LLM insights",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # CORS middleware for frontend
@@ -28,14 +55,44 @@ app.add_middleware(
 
 # Initialize database on startup
 @app.on_event("startup")
-def startup_event():
-    init_db()
-    print("Database initialized")
+async def startup_event():
+    log_listener.start()
+    root_logger = logging.getLogger()
+    root_logger.addHandler(log_handler)
+    root_logger.setLevel(logging.INFO)
+    # httpx logs every Ollama request at INFO
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    
+    await init_db()
+    log.info("Database initialized")
 
 # Initialize Ollama client
 ollama_client = OllamaClient()
 
 
+def _init_worker_logging():
+    """Log straight to stderr in parser workers, which have no event loop to protect"""
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, force=True)
+
+
+# Worker processes for CPU-bound export parsing; spawned rather than forked,
+# since forking a process that already runs threads can deadlock the child
+process_pool = ProcessPoolExecutor(
+    max_workers=2,
+    mp_context=multiprocessing.get_context("spawn"),
+    initializer=_init_worker_logging
+)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await ollama_client.aclose()
+    await response_cache.close()
+    process_pool.shutdown(wait=False, cancel_futures=True)
+    logging.getLogger().removeHandler(log_handler)
+    log_listener.stop()
+
+
 @app.get("/")
 def read_root():
     return {
@@ -56,98 +113,117 @@ async def health_check():
     }
 
 
-@app.post("/api/upload")
-async def upload_health_data(file: UploadFile = File(...), db: Session = Depends(get_db)):
+async def _upsert_by_date(db: AsyncSession, model, rows_by_date: Dict[date, Dict]) -> int:
+    """Insert or update rows keyed by date with INSERT ... ON CONFLICT (date) DO UPDATE.
+    
+    Returns the number of newly inserted rows.
+    """
+    if not rows_by_date:
+        return 0
+    
+    in_range = and_(model.date >= min(rows_by_date), model.date <= max(rows_by_date))
+    count_before = await db.scalar(select(func.count(model.id)).where(in_range)) or 0
+    
+    dialect_insert = sqlite_insert if engine.dialect.name == "sqlite" else postgresql_insert
+    
+    # Group rows by the columns they carry so an update only touches those fields
+    rows_by_columns = defaultdict(list)
+    for date_key, values in rows_by_date.items():
+        rows_by_columns[tuple(sorted(values))].append({'date': date_key, **values})
+    
+    for columns, rows in rows_by_columns.items():
+        stmt = dialect_insert(model)
+        if columns:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[model.date],
+                set_={column: stmt.excluded[column] for column in columns}
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=[model.date])
+        await db.execute(stmt, rows)
+    
+    count_after = await db.scalar(select(func.count(model.id)).where(in_range)) or 0
+    return count_after - count_before
+
+
+async def recompute_derived_metrics(dates: List[date]):
+    """Compute and store derived metrics for the given dates in a fresh session"""
+    async with AsyncSessionLocal() as db:
+        analytics = HealthAnalytics(db)
+        derived = await analytics.compute_derived_metrics_bulk(min(dates), max(dates))
+        
+        await _upsert_by_date(db, DerivedMetric, {
+            date_key: derived[date_key] for date_key in dates if date_key in derived
+        })
+        
+        await db.commit()
+    
+    await response_cache.clear("reads")
+
+
+def _parse_file(path: str, is_zip: bool) -> Dict:
+    """Parse an export file; runs in a worker process"""
+    try:
+        return AppleHealthParser(path, is_zip=is_zip).parse()
+    except etree.XMLSyntaxError as e:
+        # lxml's error log can't be pickled back to the parent, so send the message only
+        raise ValueError(str(e)) from None
+
+
+@app.post("/api/upload", status_code=202)
+async def upload_health_data(
+    background_tasks: BackgroundTasks,
+    file: UploadFile = File(...),
+    db: AsyncSession = Depends(get_db)
+):
     """Upload and parse Apple Health export file (XML or ZIP)"""
     
     # Validate file type
     if not file.filename or not (file.filename.endswith('.xml') or file.filename.endswith('.zip')):
         raise HTTPException(status_code=400, detail="File must be .xml or .zip")
     
-    # Save uploaded file temporarily
-    temp_path = f"/tmp/{file.filename}"
     try:
-        with open(temp_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        loop = asyncio.get_running_loop()
         
-        # Parse the file
-        parser = AppleHealthParser(temp_path)
-        parsed_data = parser.parse()
+        # Worker processes need a path, so spool the upload to a self-deleting named file
+        with tempfile.NamedTemporaryFile() as temp_file:
+            await loop.run_in_executor(None, partial(shutil.copyfileobj, file.file, temp_file))
+            temp_file.flush()
+            
+            # Parse off the event loop so other requests keep being served
+            parsed_data = await loop.run_in_executor(
+                process_pool, _parse_file, temp_file.name, file.filename.endswith('.zip')
+            )
         
         # Store sleep data
-        sleep_records_added = 0
-        for date_key, sleep_data in parsed_data['sleep'].items():
-            existing = db.query(SleepRecord).filter(SleepRecord.date == date_key).first()
-            
-            if existing:
-                # Update existing record
-                for key, value in sleep_data.items():
-                    setattr(existing, key, value)
-            else:
-                # Create new record
-                record = SleepRecord(date=date_key, **sleep_data)
-                db.add(record)
-                sleep_records_added += 1
+        sleep_records_added = await _upsert_by_date(db, SleepRecord, parsed_data['sleep'])
         
         # Store activity data
-        activity_records_added = 0
-        for date_key, activity_data in parsed_data['activity'].items():
-            existing = db.query(ActivityRecord).filter(ActivityRecord.date == date_key).first()
-            
-            if existing:
-                existing.steps = activity_data['steps']
-                existing.move_calories = activity_data['calories']
-                existing.stand_hours = activity_data['stand_hours']
-            else:
-                record = ActivityRecord(
-                    date=date_key,
-                    steps=activity_data['steps'],
-                    move_calories=activity_data['calories'],
-                    stand_hours=activity_data['stand_hours']
-                )
-                db.add(record)
-                activity_records_added += 1
+        activity_records_added = await _upsert_by_date(db, ActivityRecord, {
+            date_key: {
+                'steps': activity_data['steps'],
+                'move_calories': activity_data['calories'],
+                'stand_hours': activity_data['stand_hours']
+            }
+            for date_key, activity_data in parsed_data['activity'].items()
+        })
         
         # Store vitals data
-        vitals_records_added = 0
-        for date_key, vitals_data in parsed_data['vitals'].items():
-            existing = db.query(VitalsRecord).filter(VitalsRecord.date == date_key).first()
-            
-            if existing:
-                for key, value in vitals_data.items():
-                    setattr(existing, key, value)
-            else:
-                record = VitalsRecord(date=date_key, **vitals_data)
-                db.add(record)
-                vitals_records_added += 1
-        
-        db.commit()
-        
-        # Compute derived metrics for all dates
-        analytics = HealthAnalytics(db)
-        metrics_computed = 0
+        vitals_records_added = await _upsert_by_date(db, VitalsRecord, parsed_data['vitals'])
         
-        for date_key in parsed_data['sleep'].keys():
-            metrics = analytics.compute_derived_metrics(date_key)
-            if metrics:
-                existing = db.query(DerivedMetric).filter(DerivedMetric.date == date_key).first()
-                if existing:
-                    for key, value in metrics.items():
-                        setattr(existing, key, value)
-                else:
-                    metric_record = DerivedMetric(date=date_key, **metrics)
-                    db.add(metric_record)
-                    metrics_computed += 1
+        await db.commit()
         
-        db.commit()
+        # Compute derived metrics after the response is sent
+        if parsed_data['sleep']:
+            background_tasks.add_task(recompute_derived_metrics, list(parsed_data['sleep'].keys()))
         
         return {
-            "message": "Data uploaded successfully",
+            "status": "accepted",
+            "message": "Data uploaded successfully, derived metrics are being computed",
             "records_added": {
                 "sleep": sleep_records_added,
                 "activity": activity_records_added,
-                "vitals": vitals_records_added,
-                "derived_metrics": metrics_computed
+                "vitals": vitals_records_added
             }
         }
     
@@ -155,123 +231,75 @@ async def upload_health_data(file: UploadFile = File(...), db: Session = Depends
         raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
     
     finally:
-        # Cleanup temp file
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
+        # Drop cached reads and insights so the dashboard sees the new data
+        await response_cache.clear("reads")
+        await response_cache.clear("insights")
 
 
-@app.get("/api/sleep")
-def get_sleep_records(days: int = Query(7, ge=1, le=365), db: Session = Depends(get_db)):
-    """Get sleep records for the last N days"""
+async def _records_in_window(db: AsyncSession, model, days: int, columns: tuple) -> Dict:
+    """Fetch the given columns of a per-date table for the last N days, newest first"""
     end_date = date.today()
     start_date = end_date - timedelta(days=days)
+    table = model.__table__
     
-    records = db.query(SleepRecord).filter(
-        SleepRecord.date >= start_date,
-        SleepRecord.date <= end_date
-    ).order_by(SleepRecord.date.desc()).all()
+    result = await db.execute(
+        select(*(table.c[name] for name in columns)).where(
+            table.c.date >= start_date,
+            table.c.date <= end_date
+        ).order_by(table.c.date.desc())
+    )
+    records = [dict(row) for row in result.mappings()]
     
     return {
-        "records": [
-            {
-                "date": str(r.date),
-                "time_in_bed_minutes": r.time_in_bed_minutes,
-                "time_asleep_minutes": r.time_asleep_minutes,
-                "awake_minutes": r.awake_minutes,
-                "rem_minutes": r.rem_minutes,
-                "core_minutes": r.core_minutes,
-                "deep_minutes": r.deep_minutes,
-                "bedtime": r.bedtime.isoformat() if r.bedtime is not None else None,
-                "wake_time": r.wake_time.isoformat() if r.wake_time is not None else None
-            }
-            for r in records
-        ],
+        "records": records,
         "count": len(records)
     }
 
 
+@app.get("/api/sleep")
+@response_cache.cached("reads")
+async def get_sleep_records(days: int = Query(7, ge=1, le=365), db: AsyncSession = Depends(get_db)):
+    """Get sleep records for the last N days"""
+    return await _records_in_window(db, SleepRecord, days, (
+        "date", "time_in_bed_minutes", "time_asleep_minutes", "awake_minutes",
+        "rem_minutes", "core_minutes", "deep_minutes", "bedtime", "wake_time"
+    ))
+
+
 @app.get("/api/activity")
-def get_activity_records(days: int = Query(7, ge=1, le=365), db: Session = Depends(get_db)):
+@response_cache.cached("reads")
+async def get_activity_records(days: int = Query(7, ge=1, le=365), db: AsyncSession = Depends(get_db)):
     """Get activity records for the last N days"""
-    end_date = date.today()
-    start_date = end_date - timedelta(days=days)
-    
-    records = db.query(ActivityRecord).filter(
-        ActivityRecord.date >= start_date,
-        ActivityRecord.date <= end_date
-    ).order_by(ActivityRecord.date.desc()).all()
-    
-    return {
-        "records": [
-            {
-                "date": str(r.date),
-                "steps": r.steps,
-                "move_calories": r.move_calories,
-                "stand_hours": r.stand_hours
-            }
-            for r in records
-        ],
-        "count": len(records)
-    }
+    return await _records_in_window(db, ActivityRecord, days, (
+        "date", "steps", "move_calories", "stand_hours"
+    ))
 
 
 @app.get("/api/vitals")
-def get_vitals_records(days: int = Query(7, ge=1, le=365), db: Session = Depends(get_db)):
+@response_cache.cached("reads")
+async def get_vitals_records(days: int = Query(7, ge=1, le=365), db: AsyncSession = Depends(get_db)):
     """Get vitals records for the last N days"""
-    end_date = date.today()
-    start_date = end_date - timedelta(days=days)
-    
-    records = db.query(VitalsRecord).filter(
-        VitalsRecord.date >= start_date,
-        VitalsRecord.date <= end_date
-    ).order_by(VitalsRecord.date.desc()).all()
-    
-    return {
-        "records": [
-            {
-                "date": str(r.date),
-                "resting_heart_rate": r.resting_heart_rate,
-                "sleeping_heart_rate": r.sleeping_heart_rate,
-                "respiratory_rate": r.respiratory_rate
-            }
-            for r in records
-        ],
-        "count": len(records)
-    }
+    return await _records_in_window(db, VitalsRecord, days, (
+        "date", "resting_heart_rate", "sleeping_heart_rate", "respiratory_rate"
+    ))
 
 
 @app.get("/api/metrics/derived")
-def get_derived_metrics(days: int = Query(7, ge=1, le=365), db: Session = Depends(get_db)):
+@response_cache.cached("reads")
+async def get_derived_metrics(days: int = Query(7, ge=1, le=365), db: AsyncSession = Depends(get_db)):
     """Get derived metrics for the last N days"""
-    end_date = date.today()
-    start_date = end_date - timedelta(days=days)
-    
-    records = db.query(DerivedMetric).filter(
-        DerivedMetric.date >= start_date,
-        DerivedMetric.date <= end_date
-    ).order_by(DerivedMetric.date.desc()).all()
-    
-    return {
-        "records": [
-            {
-                "date": str(r.date),
-                "sleep_consistency_score": r.sleep_consistency_score,
-                "sleep_fragmentation_index": r.sleep_fragmentation_index,
-                "rem_percentage": r.rem_percentage,
-                "deep_percentage": r.deep_percentage,
-                "sleep_efficiency": r.sleep_efficiency
-            }
-            for r in records
-        ],
-        "count": len(records)
-    }
+    return await _records_in_window(db, DerivedMetric, days, (
+        "date", "sleep_consistency_score", "sleep_fragmentation_index",
+        "rem_percentage", "deep_percentage", "sleep_efficiency"
+    ))
 
 
 @app.get("/api/analytics/sleep-summary")
-def get_sleep_summary(days: int = Query(7, ge=1, le=365), db: Session = Depends(get_db)):
+@response_cache.cached("reads")
+async def get_sleep_summary(days: int = Query(7, ge=1, le=365), db: AsyncSession = Depends(get_db)):
     """Get sleep analytics summary"""
     analytics = HealthAnalytics(db)
-    summary = analytics.get_sleep_summary(days)
+    summary = await analytics.get_sleep_summary(days)
     
     if not summary:
         raise HTTPException(status_code=404, detail="No sleep data found")
@@ -280,10 +308,11 @@ def get_sleep_summary(days: int = Query(7, ge=1, le=365), db: Session = Depends(
 
 
 @app.get("/api/analytics/activity-summary")
-def get_activity_summary(days: int = Query(7, ge=1, le=365), db: Session = Depends(get_db)):
+@response_cache.cached("reads")
+async def get_activity_summary(days: int = Query(7, ge=1, le=365), db: AsyncSession = Depends(get_db)):
     """Get activity analytics summary"""
     analytics = HealthAnalytics(db)
-    summary = analytics.get_activity_summary(days)
+    summary = await analytics.get_activity_summary(days)
     
     if not summary:
         raise HTTPException(status_code=404, detail="No activity data found")
@@ -292,26 +321,37 @@ def get_activity_summary(days: int = Query(7, ge=1, le=365), db: Session = Depen
 
 
 @app.get("/api/analytics/correlations")
-def get_correlations(db: Session = Depends(get_db)):
+@response_cache.cached("reads")
+async def get_correlations(db: AsyncSession = Depends(get_db)):
     """Get correlations between activity and sleep"""
     analytics = HealthAnalytics(db)
-    correlations = analytics.get_correlations()
+    correlations = await analytics.get_correlations()
     
     return correlations
 
 
 @app.post("/api/insights/generate")
-async def generate_insights(days: int = Query(7, ge=1, le=30), db: Session = Depends(get_db)):
+async def generate_insights(days: int = Query(7, ge=1, le=30), db: AsyncSession = Depends(get_db)):
     """Generate AI insights using local LLM"""
     
+    # Summaries are relative to today, so key on today's date plus the data's latest date and size
+    last_date, sleep_count = (await db.execute(
+        select(func.max(SleepRecord.date), func.count(SleepRecord.id))
+    )).one()
+    cache_key = response_cache.make_key("insights", date.today(), days, last_date, sleep_count)
+    
+    cached_response = await response_cache.get(cache_key)
+    if cached_response is not None:
+        return orjson.loads(cached_response)
+    
     analytics = HealthAnalytics(db)
     
     # Gather context
-    sleep_summary = analytics.get_sleep_summary(days)
-    sleep_summary_30 = analytics.get_sleep_summary(30) if days < 30 else None
-    activity_summary = analytics.get_activity_summary(days)
-    notable_patterns = analytics.get_notable_patterns(days)
-    correlations = analytics.get_correlations()
+    sleep_summary = await analytics.get_sleep_summary(days)
+    sleep_summary_30 = await analytics.get_sleep_summary(30) if days < 30 else None
+    activity_summary = await analytics.get_activity_summary(days)
+    notable_patterns = await analytics.get_notable_patterns(days)
+    correlations = await analytics.get_correlations()
     
     if not sleep_summary:
         raise HTTPException(status_code=404, detail="Insufficient data for insights")
@@ -331,23 +371,31 @@ async def generate_insights(days: int = Query(7, ge=1, le=30), db: Session = Dep
     # Generate insights
     insights = await ollama_client.generate_insights(context)
     
-    return {
+    response = {
         **insights,
-        "generated_at": datetime.utcnow().isoformat(),
+        "generated_at": datetime.utcnow(),
         "context": context
     }
+    
+    # Don't pin a failed LLM call in the cache
+    if "error" not in insights:
+        await response_cache.set(cache_key, orjson.dumps(response, option=orjson.OPT_SERIALIZE_NUMPY), expire=3600)
+    
+    return response
 
 
 @app.get("/api/stats")
-def get_database_stats(db: Session = Depends(get_db)):
+@response_cache.cached("reads")
+async def get_database_stats(db: AsyncSession = Depends(get_db)):
     """Get database statistics"""
-    sleep_count = db.query(SleepRecord).count()
-    activity_count = db.query(ActivityRecord).count()
-    vitals_count = db.query(VitalsRecord).count()
+    sleep_count = await db.scalar(select(func.count(SleepRecord.id)))
+    activity_count = await db.scalar(select(func.count(ActivityRecord.id)))
+    vitals_count = await db.scalar(select(func.count(VitalsRecord.id)))
     
     # Get date range
-    first_sleep = db.query(SleepRecord).order_by(SleepRecord.date.asc()).first()
-    last_sleep = db.query(SleepRecord).order_by(SleepRecord.date.desc()).first()
+    first_date, last_date = (await db.execute(
+        select(func.min(SleepRecord.date), func.max(SleepRecord.date))
+    )).one()
     
     return {
         "total_records": {
@@ -356,7 +404,7 @@ def get_database_stats(db: Session = Depends(get_db)):
             "vitals": vitals_count
         },
         "date_range": {
-            "first_date": str(first_sleep.date) if first_sleep else None,
-            "last_date": str(last_sleep.date) if last_sleep else None
+            "first_date": first_date,
+            "last_date": last_date
         }
     }
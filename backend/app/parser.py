@@ -1,22 +1,39 @@
-import xml.etree.ElementTree as ET
+from lxml import etree  # pyright: ignore[reportAttributeAccessIssue]
 from datetime import datetime, date
-from typing import Dict, List, Tuple
+from typing import IO, Dict, Optional, Union
 from collections import defaultdict
 import zipfile
-import os
-from dateutil import parser as date_parser
+import logging
+import math
+import sys
+
+
+# Apple Health timestamps are always "YYYY-MM-DD HH:MM:SS ±ZZZZ"
+APPLE_HEALTH_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+log = logging.getLogger(__name__)
+
+
+def _parse_date(value: str) -> date:
+    """Extract the calendar date from an Apple Health timestamp"""
+    return date.fromisoformat(value[:10])
+
+
+def _parse_datetime(value: str) -> datetime:
+    """Parse a full timezone-aware Apple Health timestamp"""
+    return datetime.strptime(value, APPLE_HEALTH_DATETIME_FORMAT)
 
 
 class AppleHealthParser:
     """Parse Apple Health export XML and extract health data"""
     
-    # Apple Health record type identifiers
-    SLEEP_ANALYSIS = "HKCategoryTypeIdentifierSleepAnalysis"
-    STEP_COUNT = "HKQuantityTypeIdentifierStepCount"
-    ACTIVE_ENERGY = "HKQuantityTypeIdentifierActiveEnergyBurned"
-    STAND_HOUR = "HKQuantityTypeIdentifierAppleStandHour"
-    HEART_RATE = "HKQuantityTypeIdentifierHeartRate"
-    RESPIRATORY_RATE = "HKQuantityTypeIdentifierRespiratoryRate"
+    # Apple Health record type identifiers (interned, as they key the handler dict)
+    SLEEP_ANALYSIS = sys.intern("HKCategoryTypeIdentifierSleepAnalysis")
+    STEP_COUNT = sys.intern("HKQuantityTypeIdentifierStepCount")
+    ACTIVE_ENERGY = sys.intern("HKQuantityTypeIdentifierActiveEnergyBurned")
+    STAND_HOUR = sys.intern("HKQuantityTypeIdentifierAppleStandHour")
+    HEART_RATE = sys.intern("HKQuantityTypeIdentifierHeartRate")
+    RESPIRATORY_RATE = sys.intern("HKQuantityTypeIdentifierRespiratoryRate")
     
     # Sleep stage values
     SLEEP_STAGES = {
@@ -28,20 +45,47 @@ class AppleHealthParser:
         "HKCategoryValueSleepAnalysisInBed": "in_bed"
     }
     
-    def __init__(self, file_path: str):
-        self.file_path = file_path
-        self.is_zip = file_path.endswith('.zip')
+    # Daily totals each sleep stage's duration counts towards
+    STAGE_FIELDS = {
+        "in_bed": ("time_in_bed_minutes",),
+        "asleep": ("time_asleep_minutes",),
+        "awake": ("awake_minutes",),
+        "rem": ("rem_minutes", "time_asleep_minutes"),
+        "core": ("core_minutes", "time_asleep_minutes"),
+        "deep": ("deep_minutes", "time_asleep_minutes")
+    }
+    
+    def __init__(self, source: Union[str, IO[bytes]], is_zip: Optional[bool] = None):
+        # source is a path or a readable binary file object; is_zip is
+        # required for file objects since there is no name to check
+        if is_zip is None:
+            if not isinstance(source, str):
+                raise ValueError("is_zip must be given when parsing from a file object")
+            is_zip = source.endswith('.zip')
+        
+        self.source = source
+        self.is_zip = is_zip
+        
+        # Record type -> handler, so the parse loop does one lookup per Record
+        self._handlers = {
+            self.SLEEP_ANALYSIS: self._parse_sleep_record,
+            self.STEP_COUNT: self._parse_steps,
+            self.ACTIVE_ENERGY: self._parse_calories,
+            self.STAND_HOUR: self._parse_stand_hours,
+            self.HEART_RATE: self._parse_heart_rate,
+            self.RESPIRATORY_RATE: self._parse_respiratory_rate
+        }
         
     def parse(self) -> Dict:
         """Main parsing method"""
         if self.is_zip:
             return self._parse_zip()
         else:
-            return self._parse_xml(self.file_path)
+            return self._parse_xml(self.source)
     
     def _parse_zip(self) -> Dict:
         """Extract and parse export.xml from zip file"""
-        with zipfile.ZipFile(self.file_path, 'r') as zip_ref:
+        with zipfile.ZipFile(self.source, 'r') as zip_ref:
             # Look for export.xml in the zip
             xml_file = None
             for name in zip_ref.namelist():
@@ -52,95 +96,16 @@ class AppleHealthParser:
             if not xml_file:
                 raise ValueError("No export.xml found in zip file")
             
-            # Extract to temp location
-            temp_path = "/tmp/export_temp.xml"
-            with zip_ref.open(xml_file) as source, open(temp_path, 'wb') as target:
-                target.write(source.read())
-            
-            result = self._parse_xml(temp_path)
-            
-            # Cleanup
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
-            
-            return result
-    
-    def _parse_xml(self, xml_path: str) -> Dict:
-        """Parse Apple Health XML file"""
-        print(f"Parsing XML file: {xml_path}")
-        
-        sleep_data = []
-        activity_data = defaultdict(lambda: {'steps': 0, 'calories': 0, 'stand_hours': 0})
-        vitals_data = defaultdict(lambda: {'heart_rates': [], 'respiratory_rates': []})
-        
-        # Use iterparse for memory efficiency with large files
-        context = ET.iterparse(xml_path, events=('start', 'end'))
-        context = iter(context)
-        
-        for event, elem in context:
-            if event == 'end':
-                if elem.tag == 'Record':
-                    record_type = elem.get('type')
-                    
-                    # Sleep data
-                    if record_type == self.SLEEP_ANALYSIS:
-                        sleep_data.append(self._parse_sleep_record(elem))
-                    
-                    # Activity data
-                    elif record_type == self.STEP_COUNT:
-                        self._parse_steps(elem, activity_data)
-                    
-                    elif record_type == self.ACTIVE_ENERGY:
-                        self._parse_calories(elem, activity_data)
-                    
-                    elif record_type == self.STAND_HOUR:
-                        self._parse_stand_hours(elem, activity_data)
-                    
-                    # Vitals
-                    elif record_type == self.HEART_RATE:
-                        self._parse_heart_rate(elem, vitals_data)
-                    
-                    elif record_type == self.RESPIRATORY_RATE:
-                        self._parse_respiratory_rate(elem, vitals_data)
-                
-                # Clear element to save memory
-                elem.clear()
-        
-        # Aggregate sleep data by date
-        aggregated_sleep = self._aggregate_sleep_data(sleep_data)
-        
-        # Process vitals data
-        processed_vitals = self._process_vitals(vitals_data)
-        
-        return {
-            'sleep': aggregated_sleep,
-            'activity': dict(activity_data),
-            'vitals': processed_vitals
-        }
+            # Stream the member straight into the XML parser
+            with zip_ref.open(xml_file) as xml_stream:
+                return self._parse_xml(xml_stream)
     
-    def _parse_sleep_record(self, elem) -> Dict:
-        """Parse a single sleep record"""
-        start = elem.get('startDate')
-        end = elem.get('endDate')
-        value = elem.get('value')
+    def _parse_xml(self, xml_source: Union[str, IO[bytes]]) -> Dict:
+        """Parse Apple Health XML from a path or file object"""
+        source_name = xml_source if isinstance(xml_source, str) else getattr(xml_source, 'name', None) or 'upload'
+        log.info("Parsing XML file: %s", source_name)
         
-        start_dt = date_parser.parse(start)
-        end_dt = date_parser.parse(end)
-        duration_minutes = (end_dt - start_dt).total_seconds() / 60
-        
-        stage = self.SLEEP_STAGES.get(value, 'unknown')
-        
-        return {
-            'start': start_dt,
-            'end': end_dt,
-            'duration_minutes': duration_minutes,
-            'stage': stage,
-            'date': start_dt.date()
-        }
-    
-    def _aggregate_sleep_data(self, sleep_records: List[Dict]) -> Dict:
-        """Aggregate sleep records by date"""
-        daily_sleep = defaultdict(lambda: {
+        self._sleep = defaultdict(lambda: {
             'time_in_bed_minutes': 0,
             'time_asleep_minutes': 0,
             'awake_minutes': 0,
@@ -150,83 +115,111 @@ class AppleHealthParser:
             'bedtime': None,
             'wake_time': None
         })
+        self._activity = defaultdict(lambda: {'steps': 0, 'calories': 0.0, 'stand_hours': 0})
+        self._vitals = defaultdict(lambda: {'hr_min': math.inf, 'hr_sum': 0.0, 'hr_count': 0, 'rr_sum': 0.0, 'rr_count': 0})
         
-        for record in sleep_records:
-            record_date = record['date']
-            stage = record['stage']
-            duration = record['duration_minutes']
-            
-            # Track bedtime and wake time
-            if daily_sleep[record_date]['bedtime'] is None or record['start'] < daily_sleep[record_date]['bedtime']:
-                daily_sleep[record_date]['bedtime'] = record['start']
-            
-            if daily_sleep[record_date]['wake_time'] is None or record['end'] > daily_sleep[record_date]['wake_time']:
-                daily_sleep[record_date]['wake_time'] = record['end']
+        # Use lxml's C iterparse for memory efficiency with large files,
+        # only surfacing completed <Record> elements
+        context = etree.iterparse(xml_source, events=('end',), tag='Record', huge_tree=True)
+        
+        handlers = self._handlers
+        
+        for _, elem in context:
+            handler = handlers.get(elem.get('type'))
+            if handler is not None:
+                handler(elem)
             
-            # Accumulate durations by stage
-            if stage == 'in_bed':
-                daily_sleep[record_date]['time_in_bed_minutes'] += duration
-            elif stage == 'asleep':
-                daily_sleep[record_date]['time_asleep_minutes'] += duration
-            elif stage == 'awake':
-                daily_sleep[record_date]['awake_minutes'] += duration
-            elif stage == 'rem':
-                daily_sleep[record_date]['rem_minutes'] += duration
-                daily_sleep[record_date]['time_asleep_minutes'] += duration
-            elif stage == 'core':
-                daily_sleep[record_date]['core_minutes'] += duration
-                daily_sleep[record_date]['time_asleep_minutes'] += duration
-            elif stage == 'deep':
-                daily_sleep[record_date]['deep_minutes'] += duration
-                daily_sleep[record_date]['time_asleep_minutes'] += duration
-        
-        return dict(daily_sleep)
+            # Clear element and already-processed siblings to save memory
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        
+        # bedtime/wake_time columns are TIMESTAMP WITHOUT TIME ZONE, so store the
+        # local wall-clock time (asyncpg rejects offset-aware values there)
+        for night in self._sleep.values():
+            night['bedtime'] = night['bedtime'].replace(tzinfo=None)
+            night['wake_time'] = night['wake_time'].replace(tzinfo=None)
+        
+        # Process vitals data
+        processed_vitals = self._process_vitals(self._vitals)
+        
+        return {
+            'sleep': dict(self._sleep),
+            'activity': dict(self._activity),
+            'vitals': processed_vitals
+        }
+    
+    def _parse_sleep_record(self, elem):
+        """Fold a single sleep record into its night's totals"""
+        start_dt = _parse_datetime(elem.get('startDate'))
+        end_dt = _parse_datetime(elem.get('endDate'))
+        duration = (end_dt - start_dt).total_seconds() / 60
+        
+        stage = self.SLEEP_STAGES.get(elem.get('value'), 'unknown')
+        d = self._sleep[start_dt.date()]
+        
+        # Track bedtime and wake time
+        if d['bedtime'] is None or start_dt < d['bedtime']:
+            d['bedtime'] = start_dt
+        
+        if d['wake_time'] is None or end_dt > d['wake_time']:
+            d['wake_time'] = end_dt
+        
+        # Accumulate durations by stage
+        for field in self.STAGE_FIELDS.get(stage, ()):
+            d[field] += duration
     
-    def _parse_steps(self, elem, activity_data):
+    def _parse_steps(self, elem):
         """Parse step count"""
-        start_date = date_parser.parse(elem.get('startDate')).date()
+        start_date = _parse_date(elem.get('startDate'))
         value = float(elem.get('value', 0))
-        activity_data[start_date]['steps'] += int(value)
+        self._activity[start_date]['steps'] += int(value)
     
-    def _parse_calories(self, elem, activity_data):
+    def _parse_calories(self, elem):
         """Parse active energy burned"""
-        start_date = date_parser.parse(elem.get('startDate')).date()
+        start_date = _parse_date(elem.get('startDate'))
         value = float(elem.get('value', 0))
-        activity_data[start_date]['calories'] += value
+        self._activity[start_date]['calories'] += value
     
-    def _parse_stand_hours(self, elem, activity_data):
+    def _parse_stand_hours(self, elem):
         """Parse stand hours"""
-        start_date = date_parser.parse(elem.get('startDate')).date()
+        start_date = _parse_date(elem.get('startDate'))
         value = int(float(elem.get('value', 0)))
         if value > 0:
-            activity_data[start_date]['stand_hours'] += 1
+            self._activity[start_date]['stand_hours'] += 1
     
-    def _parse_heart_rate(self, elem, vitals_data):
+    def _parse_heart_rate(self, elem):
         """Parse heart rate"""
-        start_date = date_parser.parse(elem.get('startDate')).date()
+        start_date = _parse_date(elem.get('startDate'))
         value = float(elem.get('value', 0))
-        vitals_data[start_date]['heart_rates'].append(value)
+        d = self._vitals[start_date]
+        if value < d['hr_min']:
+            d['hr_min'] = value
+        d['hr_sum'] += value
+        d['hr_count'] += 1
     
-    def _parse_respiratory_rate(self, elem, vitals_data):
+    def _parse_respiratory_rate(self, elem):
         """Parse respiratory rate"""
-        start_date = date_parser.parse(elem.get('startDate')).date()
+        start_date = _parse_date(elem.get('startDate'))
         value = float(elem.get('value', 0))
-        vitals_data[start_date]['respiratory_rates'].append(value)
+        d = self._vitals[start_date]
+        d['rr_sum'] += value
+        d['rr_count'] += 1
     
     def _process_vitals(self, vitals_data: Dict) -> Dict:
-        """Process vitals data to get daily averages"""
+        """Turn the running vitals totals into daily minimums and averages"""
         processed = {}
         
         for date_key, data in vitals_data.items():
             processed[date_key] = {}
             
             # Calculate resting heart rate (approximate as lowest daytime HR)
-            if data['heart_rates']:
-                processed[date_key]['resting_heart_rate'] = min(data['heart_rates'])
-                processed[date_key]['sleeping_heart_rate'] = sum(data['heart_rates']) / len(data['heart_rates'])
+            if data['hr_count']:
+                processed[date_key]['resting_heart_rate'] = data['hr_min']
+                processed[date_key]['sleeping_heart_rate'] = data['hr_sum'] / data['hr_count']
             
             # Average respiratory rate
-            if data['respiratory_rates']:
-                processed[date_key]['respiratory_rate'] = sum(data['respiratory_rates']) / len(data['respiratory_rates'])
+            if data['rr_count']:
+                processed[date_key]['respiratory_rate'] = data['rr_sum'] / data['rr_count']
         
         return processed